@@ -1,12 +1,17 @@
 import os
-import requests
+import sys
 import time
-import functools
 import asyncio
-from datetime import datetime
+import aiohttp
+from collections import OrderedDict
+import numpy as np
+import orjson
+from numba import njit
+from datetime import datetime, timedelta, timezone
+from aiolimiter import AsyncLimiter
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
 
 ODDS_KEY = os.getenv("ODDS_API_KEY")
 MOON_KEY = os.getenv("MOONSHOT_KEY")
@@ -26,138 +31,240 @@ SPORTS = [
     'darts'
 ]
 
-@functools.lru_cache(maxsize=32)
-def _get_odds_cached(sport, ttl_hash):
+ODDS_URLS = {sport: f"https://api.the-odds-api.com/v4/sports/{sport}/odds" for sport in SPORTS}
+ODDS_PARAMS = {
+    'regions': 'eu,us',
+    'markets': 'h2h',
+    'oddsFormat': 'decimal',
+    'apiKey': ODDS_KEY
+}
+
+MOON_URL = "https://api.moonshot.cn/v1/chat/completions"
+MOON_HEADERS = {
+    "Authorization": f"Bearer {MOON_KEY}",
+    "Content-Type": "application/json"
+}
+MOON_TIMEOUT = aiohttp.ClientTimeout(total=15)
+
+PICK_TMPL = (
+    "**{i}.** {fixture}\n"
+    "   **Pick:** {pick} @ {odds:.2f} (Edge: {edge:.1f}%)\n"
+    "   **Time:** {time}\n"
+    "   _Kimi Tip:_ {tip}"
+)
+
+# fromisoformat() only understands a trailing 'Z' from Python 3.11
+_FROMISO_ACCEPTS_Z = sys.version_info >= (3, 11)
+_STRFTIME_FMT = '%b %d, %H:%M UTC'
+
+# Set a reasonable limit for API usage and message size
+MAX_PICKS_PER_SPORT = 5
+# Minimum expected ROI for a pick to count as value
+MIN_EDGE = 0.05
+# Telegram rejects messages over 4096 characters
+MAX_MESSAGE_LEN = 4000
+
+_SESSION = None
+MOON_SEM = asyncio.Semaphore(6)
+# Telegram allows about 30 messages per second per bot
+TG_LIMIT = AsyncLimiter(29, 1)
+# Retries after a 429 / flood-control response before giving up
+MAX_RETRIES = 2
+# Longest Moonshot back-off honoured before giving up on a tip
+MAX_RETRY_DELAY = 5
+ODDS_TTL = 900
+# Wait before retrying after a failed odds fetch
+ODDS_RETRY_DELAY = 60
+# Oldest odds that may still be served while the API is failing
+ODDS_MAX_STALE = 3600
+# sport -> (fetched_at, checked_at, status, games); fetched_at is when games were last good
+_ODDS_CACHE = {}
+_ODDS_REFRESH = {}
+KIMI_TTL = 600
+KIMI_CACHE_MAX = 1024
+# (sport, pick, odds, edge) -> (created_at, tip), oldest first
+KIMI_CACHE = OrderedDict()
+
+def _get_session():
+    # One shared session so every request reuses the same keep-alive pool.
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10)
+        )
+    return _SESSION
+
+async def _fetch_odds(sport):
     try:
-        url = f"https://api.the-odds-api.com/v4/sports/{sport}/odds"
-        params = {
-            'regions': 'eu,us',
-            'markets': 'h2h',
-            'oddsFormat': 'decimal',
-            'apiKey': ODDS_KEY
-        }
-        r = requests.get(url, params=params, timeout=10)
-        if r.status_code == 200:
-            return r.json()
-        return []
+        async with _get_session().get(ODDS_URLS[sport], params=ODDS_PARAMS) as r:
+            if r.status == 200:
+                return r.status, orjson.loads(await r.read())
+            return r.status, []
     except Exception as e:
         print(f"Error fetching odds for {sport}: {e}")
+        return None, []
+
+def _parse_commence_time(commence_time):
+    if not _FROMISO_ACCEPTS_Z:
+        commence_time = commence_time.replace('Z', '+00:00')
+    return datetime.fromisoformat(commence_time)
+
+def _usable_games(fetched_at, games):
+    # Never fall back to odds older than ODDS_MAX_STALE, nor to matches already under way
+    if fetched_at is None or time.time() - fetched_at > ODDS_MAX_STALE:
         return []
+    now = datetime.now(timezone.utc)
+    usable = []
+    for game in games:
+        try:
+            if _parse_commence_time(game['commence_time']) <= now:
+                continue
+        except Exception:
+            pass
+        usable.append(game)
+    return usable
+
+async def _refresh_odds(sport):
+    status, games = await _fetch_odds(sport)
+    now = time.time()
+    if status == 200:
+        _ODDS_CACHE[sport] = (now, now, status, games)
+        return games
+
+    # Keep the last good odds with their original age; only record the failed attempt
+    cached = _ODDS_CACHE.get(sport)
+    fetched_at, games = (cached[0], cached[3]) if cached is not None else (None, [])
+    _ODDS_CACHE[sport] = (fetched_at, now, status, games)
+    return _usable_games(fetched_at, games)
+
+async def get_odds_async(sport):
+    cached = _ODDS_CACHE.get(sport)
+    if cached is not None:
+        fetched_at, checked_at, status, games = cached
+        if status == 200 and time.time() - fetched_at < ODDS_TTL:
+            return games
+        # After a failed fetch, back off briefly instead of hammering the API
+        if status != 200 and time.time() - checked_at < ODDS_RETRY_DELAY:
+            return _usable_games(fetched_at, games)
+
+    task = _ODDS_REFRESH.get(sport)
+    if task is None:
+        task = asyncio.create_task(_refresh_odds(sport))
+        _ODDS_REFRESH[sport] = task
+        task.add_done_callback(lambda _: _ODDS_REFRESH.pop(sport, None))
+
+    # Serve stale odds while the refresh runs; a cache without recent good odds waits on the fetch
+    if cached is not None and cached[0] is not None and time.time() - cached[0] <= ODDS_MAX_STALE:
+        return _usable_games(cached[0], cached[3])
+    return await asyncio.shield(task)
+
+async def close_session(application):
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+
+def _build_price_matrix(game):
+    # Single pass over the bookmakers: assign outcome columns as names first appear
+    name_to_col = {}
+    rows = []
+    for bookmaker in game['bookmakers']:
+        row = []
+        for outcome in bookmaker['markets'][0]['outcomes']:
+            name = outcome['name']
+            col = name_to_col.get(name)
+            if col is None:
+                col = name_to_col[name] = len(name_to_col)
+            row.append((col, outcome['price']))
+        rows.append(row)
+
+    # Bookmaker x outcome price matrix, NaN where a bookmaker has no price.
+    # Fill a flat list and convert once; per-element ndarray writes are slower.
+    n_outcomes = len(name_to_col)
+    flat = [np.nan] * (len(rows) * n_outcomes)
+    for b, row in enumerate(rows):
+        base = b * n_outcomes
+        for col, price in row:
+            flat[base + col] = price
+    prices = np.fromiter(flat, dtype=np.float64, count=len(flat)).reshape(len(rows), n_outcomes)
+
+    return list(name_to_col), prices
+
+# The explicit signature compiles the kernel at import time, so the first /tips
+# call never blocks the event loop on JIT compilation
+@njit("Tuple((int64, float64, float64))(float64[:, ::1])", cache=True)
+def _edge_kernel(prices):
+    # Returns (best_idx, best_odds, best_roi); best_idx is -1 when no edge can be computed
+    n_books, n_outcomes = prices.shape
+    vig_free = np.full((n_books, n_outcomes), np.nan)
+    best_odds = np.full(n_outcomes, np.nan)
+
+    for b in range(n_books):
+        # Take each reciprocal once, in place, then normalise the row by its sum
+        total_implied = 0.0
+        for j in range(n_outcomes):
+            price = prices[b, j]
+            if not np.isnan(price):
+                implied = 1.0 / price
+                vig_free[b, j] = implied
+                total_implied += implied
+                if np.isnan(best_odds[j]) or price > best_odds[j]:
+                    best_odds[j] = price
+        # Bookmakers without any prices carry no information
+        if total_implied == 0.0:
+            continue
 
-def get_odds(sport):
-    ttl_hash = int(time.time()) // 900
-    return _get_odds_cached(sport, ttl_hash)
+        for j in range(n_outcomes):
+            vig_free[b, j] /= total_implied
+
+    # Build the consensus without the bookmaker(s) offering the best price,
+    # falling back to every bookmaker when nobody else prices that outcome
+    consensus = np.empty(n_outcomes)
+    probs = np.empty(n_books)
+    for j in range(n_outcomes):
+        k = 0
+        for b in range(n_books):
+            if not np.isnan(vig_free[b, j]) and prices[b, j] != best_odds[j]:
+                probs[k] = vig_free[b, j]
+                k += 1
+        if k == 0:
+            for b in range(n_books):
+                if not np.isnan(vig_free[b, j]):
+                    probs[k] = vig_free[b, j]
+                    k += 1
+        if k == 0:
+            return -1, 0.0, 0.0
+        # Numba's median is quickselect based, so no full sort per outcome
+        consensus[j] = np.median(probs[:k])
+
+    total_consensus = consensus.sum()
+    if total_consensus == 0.0:
+        return -1, 0.0, 0.0
+
+    best_idx = -1
+    best_roi = -1.0
+    for j in range(n_outcomes):
+        roi = (consensus[j] / total_consensus) * best_odds[j] - 1.0
+        if roi > best_roi:
+            best_roi = roi
+            best_idx = j
+
+    if best_idx < 0:
+        return -1, 0.0, 0.0
+    return best_idx, best_odds[best_idx], best_roi
 
 def naive_edge(game):
     try:
         if not game.get('bookmakers') or len(game['bookmakers']) == 0:
             return None
 
-        outcome_names = set()
-        for bookmaker in game['bookmakers']:
-            for outcome in bookmaker['markets'][0]['outcomes']:
-                outcome_names.add(outcome['name'])
-
+        outcome_names, prices = _build_price_matrix(game)
         if len(outcome_names) < 2:
             return None
 
-        outcome_names = list(outcome_names)
-
-        best_odds_per_outcome = {}
-        bookmaker_data = []
-
-        for bookmaker in game['bookmakers']:
-            outcomes_dict = {}
-            for outcome in bookmaker['markets'][0]['outcomes']:
-                outcomes_dict[outcome['name']] = outcome['price']
-
-            implied_probs = {}
-            for name in outcome_names:
-                if name in outcomes_dict:
-                    implied_probs[name] = 1 / outcomes_dict[name]
-                else:
-                    implied_probs[name] = 0
-
-            total_implied = sum(implied_probs.values())
-            if total_implied == 0:
-                continue
-
-            vig_free = {}
-            for name in outcome_names:
-                vig_free[name] = implied_probs[name] / total_implied
-
-                if name in outcomes_dict:
-                    price = outcomes_dict[name]
-                    if name not in best_odds_per_outcome or price > best_odds_per_outcome[name]:
-                        best_odds_per_outcome[name] = price
-
-            bookmaker_data.append({
-                'vig_free': vig_free,
-                'outcomes_dict': outcomes_dict
-            })
-
-        if len(bookmaker_data) == 0:
-            return None
-
-        consensus_probs = {}
-        for name in outcome_names:
-            probs_for_consensus = []
-
-            for bm_data in bookmaker_data:
-                if name in bm_data['outcomes_dict']:
-                    price = bm_data['outcomes_dict'][name]
-                    if price == best_odds_per_outcome.get(name):
-                        continue
-
-                if bm_data['vig_free'][name] > 0:
-                    probs_for_consensus.append(bm_data['vig_free'][name])
-
-            if len(probs_for_consensus) == 0:
-                vig_free_probs_all = [bm_data['vig_free'][name] for bm_data in bookmaker_data if bm_data['vig_free'][name] > 0]
-                if len(vig_free_probs_all) == 0:
-                    return None
-                probs_for_consensus = vig_free_probs_all
-
-            sorted_probs = sorted(probs_for_consensus)
-            n = len(sorted_probs)
-
-            if n == 1:
-                consensus_probs[name] = sorted_probs[0]
-            elif n % 2 == 0:
-                median_prob = (sorted_probs[n // 2 - 1] + sorted_probs[n // 2]) / 2
-                consensus_probs[name] = median_prob
-            else:
-                median_prob = sorted_probs[n // 2]
-                consensus_probs[name] = median_prob
-
-        total_consensus = sum(consensus_probs.values())
-        if total_consensus == 0:
-            return None
-
-        fair_probs = {}
-        for name in outcome_names:
-            fair_probs[name] = consensus_probs[name] / total_consensus
+        best_idx, best_odds, best_roi = _edge_kernel(prices)
 
-        best_pick = None
-        best_roi = -1
-        best_odds = 0
-
-        for name in outcome_names:
-            if name not in best_odds_per_outcome:
-                continue
-
-            best_price = best_odds_per_outcome[name]
-            fair_prob = fair_probs[name]
-
-            expected_roi = (fair_prob * best_price) - 1
-
-            if expected_roi > best_roi:
-                best_roi = expected_roi
-                best_pick = name
-                best_odds = best_price
-
-        if best_roi >= 0.05:
-            return (best_pick, best_odds, best_roi)
+        if best_idx >= 0 and best_roi >= MIN_EDGE:
+            return (outcome_names[best_idx], best_odds, best_roi)
 
         return None
 
@@ -165,7 +272,20 @@ def naive_edge(game):
         print(f"Error calculating edge: {e}")
         return None
 
-def kimi_tip(sport, pick, odds, edge):
+def _retry_after_seconds(value, default=1.0):
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+async def kimi_tip_async(sport, pick, odds, edge):
+    # The prompt only shows odds to 2 and edge to 3 decimals, so round the key to match
+    key = (sport, pick, round(odds, 2), round(edge, 3))
+    cached = KIMI_CACHE.get(key)
+    if cached is not None and time.time() - cached[0] < KIMI_TTL:
+        KIMI_CACHE.move_to_end(key)
+        return cached[1]
+
     try:
         # Use a slightly adjusted prompt for better context with multiple picks
         prompt = (
@@ -173,118 +293,163 @@ def kimi_tip(sport, pick, odds, edge):
             f"The pick is **{pick}** at odds {odds:.2f}, showing a value edge of {edge*100:.1f}%. "
             f"Include current form, H2H, or an injury note if widely known, and be persuasive."
         )
-        headers = {
-            "Authorization": f"Bearer {MOON_KEY}",
-            "Content-Type": "application/json"
-        }
         body = {
             "model": "moonshot-v1-8k",
             "messages": [{"role": "user", "content": prompt}]
         }
-        r = requests.post(
-            "https://api.moonshot.cn/v1/chat/completions",
-            headers=headers,
-            json=body,
-            timeout=15
-        )
-        if r.status_code == 200:
-            return r.json()['choices'][0]['message']['content'].strip()
-        else:
-            return f"Tip generation unavailable (Status: {r.status_code})."
+        data = orjson.dumps(body)
+        for attempt in range(MAX_RETRIES + 1):
+            # Cap in-flight requests so a batch of picks stays within Moonshot's rate limits
+            async with MOON_SEM:
+                async with _get_session().post(
+                    MOON_URL,
+                    headers=MOON_HEADERS,
+                    data=data,
+                    timeout=MOON_TIMEOUT
+                ) as r:
+                    if r.status == 200:
+                        result = orjson.loads(await r.read())
+                        tip = result['choices'][0]['message']['content'].strip()
+                        KIMI_CACHE[key] = (time.time(), tip)
+                        KIMI_CACHE.move_to_end(key)
+                        if len(KIMI_CACHE) > KIMI_CACHE_MAX:
+                            KIMI_CACHE.popitem(last=False)
+                        return tip
+                    delay = _retry_after_seconds(r.headers.get('Retry-After'))
+                    # Don't stall the sport's block on a long advertised back-off
+                    if r.status != 429 or attempt == MAX_RETRIES or delay > MAX_RETRY_DELAY:
+                        return f"Tip generation unavailable (Status: {r.status})."
+            # Back off outside the semaphore so other picks can use the slot meanwhile
+            await asyncio.sleep(delay)
     except Exception as e:
         print(f"Error generating tip: {e}")
         return "Analysis suggests high value in this pick based on odds comparison."
 
 
-# NOTE: The custom send_long_message function is removed as the new logic 
-# in the 'tips' function handles message splitting more safely by using
-# the existing 'msg' structure.
+async def _reply(message, text, markdown=True):
+    # Every outgoing message passes through TG_LIMIT to stay under Telegram's flood limits.
+    # The user is waiting on these messages, so Telegram's flood wait is honoured in full.
+    send = message.reply_markdown if markdown else message.reply_text
+    for attempt in range(MAX_RETRIES + 1):
+        async with TG_LIMIT:
+            try:
+                return await send(text)
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = e.retry_after
+        await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+
+
+def _split_message(parts, limit=MAX_MESSAGE_LEN):
+    # Split a sport block on pick boundaries so no message exceeds Telegram's limit
+    chunks = []
+    current = []
+    length = 0
+    for part in parts:
+        if current and length + len(part) + 1 > limit:
+            chunks.append("\n".join(current))
+            current = []
+            length = 0
+        current.append(part)
+        length += len(part) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+async def _sport_block(sport):
+    games = await get_odds_async(sport)
+    if not games:
+        return None
 
+    value_picks = []
 
-async def tips(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # This process will take longer due to multiple API calls, so use a detailed initial message.
-    await update.message.reply_text("🔍 Analyzing odds across markets... This may take up to a minute to process all value picks and generate AI analysis. Please wait.")
+    # 1. Collect all valid value picks for the sport
+    for game in games:
+        edge_result = naive_edge(game)
+        if edge_result:
+            pick, odds, edge = edge_result
+            # Store (edge, game, pick, odds) to sort later
+            value_picks.append((edge, game, pick, odds)) 
 
-    # Set a reasonable limit for API usage and message size
-    MAX_PICKS_PER_SPORT = 5
+    if not value_picks:
+        return None
 
-    msg = []
+    # 2. Sort by edge (ROI) in descending order and take the top N
+    value_picks.sort(key=lambda x: x[0], reverse=True)
+    top_picks = value_picks[:MAX_PICKS_PER_SPORT]
+    sport_name = sport.upper().replace('_', ' ')
+
+    # 3. Generate the Kimi tips for this sport's picks in one concurrent batch
+    tip_results = await asyncio.gather(*(
+        kimi_tip_async(sport_name, pick, odds, edge)
+        for edge, game, pick, odds in top_picks
+    ))
+
+    # 4. Build the message block for this sport
+    parts = [f"🏆 **{sport_name}** ({len(top_picks)} Value Picks Found)"]
+
+    for i, ((edge, game, pick, odds), tip) in enumerate(zip(top_picks, tip_results)):
+        # Format time
+        commence_time = game.get('commence_time', '')
+        date_str = ''
+        if commence_time:
+            try:
+                # Convert to datetime object and format
+                date_str = _parse_commence_time(commence_time).strftime(_STRFTIME_FMT)
+            except:
+                date_str = ''
+
+        parts.append(PICK_TMPL.format_map({
+            'i': i + 1,
+            'fixture': f"{game.get('home_team', 'Team A')} vs {game.get('away_team', 'Team B')}",
+            'pick': pick,
+            'odds': odds,
+            'edge': edge * 100,
+            'time': date_str,
+            'tip': tip,
+        }))
+
+    return parts
 
-    for sport in SPORTS:
-        games = get_odds(sport)
-        if not games:
-            continue
 
-        value_picks = []
+async def tips(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # This process will take longer due to multiple API calls, so use a detailed initial message.
+    await _reply(update.message, "🔍 Analyzing odds across markets... This may take up to a minute to process all value picks and generate AI analysis. Please wait.", markdown=False)
 
-        # 1. Collect all valid value picks for the sport
-        for game in games:
-            edge_result = naive_edge(game)
-            if edge_result:
-                pick, odds, edge = edge_result
-                # Store (edge, game, pick, odds) to sort later
-                value_picks.append((edge, game, pick, odds)) 
+    sports_found = 0
 
-        if not value_picks:
+    # Process every sport concurrently and send each block as soon as it is ready
+    for next_block in asyncio.as_completed([_sport_block(s) for s in SPORTS]):
+        try:
+            parts = await next_block
+        except Exception as e:
+            print(f"Error building tips block: {e}")
+            continue
+        if not parts:
             continue
 
-        # 2. Sort by edge (ROI) in descending order and take the top N
-        value_picks.sort(key=lambda x: x[0], reverse=True)
-        top_picks = value_picks[:MAX_PICKS_PER_SPORT]
-
-        # 3. Start building the message block for this sport
-        sport_name = sport.upper().replace('_', ' ')
-        sport_msg = [f"🏆 **{sport_name}** ({len(top_picks)} Value Picks Found)"]
-
-        for i, (edge, game, pick, odds) in enumerate(top_picks):
-            # Format time
-            commence_time = game.get('commence_time', '')
-            date_str = ''
-            if commence_time:
-                try:
-                    # Convert to datetime object and format
-                    match_time = datetime.fromisoformat(commence_time.replace('Z', '+00:00'))
-                    date_str = match_time.strftime('%b %d, %H:%M UTC')
-                except:
-                    date_str = ''
-
-            home_team = game.get('home_team', 'Team A')
-            away_team = game.get('away_team', 'Team B')
-            fixture = f"{home_team} vs {away_team}"
-
-            # 4. Call Kimi for the tip
-            tip = kimi_tip(sport_name, pick, odds, edge)
-
-            # Format message for this specific pick
-            pick_msg = (
-                f"**{i+1}.** {fixture}\n"
-                f"   **Pick:** {pick} @ {odds:.2f} (Edge: {edge*100:.1f}%)\n"
-                f"   **Time:** {date_str}\n"
-                f"   _Kimi Tip:_ {tip}"
-            )
-            sport_msg.append(pick_msg)
-
-        msg.append("\n".join(sport_msg)) # Append the entire sport block to the main message list
-
-    # 5. Send the final compiled message in separate messages for each sport
+        sports_found += 1
+        for chunk in _split_message(parts):
+            # Skip a chunk Telegram still refuses so the remaining blocks are drained and sent
+            try:
+                await _reply(update.message, chunk)
+            except TelegramError as e:
+                print(f"Error sending tips block: {e}")
+
+    # 5. Finish with a summary and the footer/disclaimer
     footer = "\n\n---\n⚠️ 18+ | Gamble responsibly | begambleaware.org"
     
-    if not msg:
-        await update.message.reply_markdown("No games with value picks found today." + footer)
+    if not sports_found:
+        await _reply(update.message, "No games with value picks found today." + footer)
         return
 
-    # Send an introduction message
-    await update.message.reply_markdown(
-        f"✅ Analysis complete! Found picks in **{len(msg)}** sport categories. See details below:"
+    await _reply(
+        update.message,
+        f"✅ Analysis complete! Found picks in **{sports_found}** sport categories." + footer
     )
 
-    # Send each sport's collected tips as a separate message to prevent the length error
-    for sport_picks_message in msg:
-        await update.message.reply_markdown(sport_picks_message)
-
-    # Send the footer/disclaimer message last
-    await update.message.reply_markdown(footer)
-
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors in the telegram bot."""
@@ -292,8 +457,10 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Notify user about the error
     if update and update.effective_message:
-        await update.effective_message.reply_text(
-            "Sorry, there was an error processing your request. Please try again."
+        await _reply(
+            update.effective_message,
+            "Sorry, there was an error processing your request. Please try again.",
+            markdown=False
         )
 
 def main():
@@ -301,7 +468,7 @@ def main():
         print("Error: TELEGRAM_TOKEN environment variable not set.")
         return
 
-    application = Application.builder().token(TG_TOKEN).build()
+    application = Application.builder().token(TG_TOKEN).post_shutdown(close_session).build()
 
     application.add_handler(CommandHandler("tips", tips))
     application.add_error_handler(error_handler)